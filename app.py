@@ -1,39 +1,89 @@
 # File: app.py - FIXED VERSION
 import asyncio
-import json
 import base64
+import collections
 import datetime
+import functools
+import gzip
+import hashlib
+import hmac
 import os
+import re
+import time
 import bcrypt
 import jwt
-from typing import List, Optional
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Body, Depends
-from fastapi.responses import FileResponse
+import orjson
+import redis.asyncio as aioredis
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Coroutine, List, Optional, Tuple
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException, Body, Depends
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
 import uvicorn
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore_async
 
 # ---------------- CONFIG ----------------
 JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY", "a_very_secret_key_for_dev")
+# PyJWT re-encodes str keys on every call; hand it bytes instead.
+_JWT_KEY = JWT_SECRET_KEY.encode()
 WORKER_SECRET_KEY = os.environ.get("WORKER_SECRET_KEY")
 if not WORKER_SECRET_KEY:
     print("⚠️  Warning: WORKER_SECRET_KEY not set (dev only).")
 
+MAX_WEB_CLIENTS = int(os.environ.get("MAX_WEB_CLIENTS", "10000"))
+# Outbound backlog per browser / towards the worker before backpressure kicks in.
+WEB_CLIENT_QUEUE_SIZE = 256
+WORKER_QUEUE_SIZE = 1024
+# Upper bound on the text merged into one stream_chunk frame.
+COALESCE_LIMIT = 16 * 1024
+# Most queued frames joined into one JSON array frame for a lagging browser.
+BATCH_MAX_FRAMES = 64
+
+# Stream frames are a few bytes each; deflating them costs CPU for nothing.
+WS_PER_MESSAGE_DEFLATE = os.environ.get("WS_PER_MESSAGE_DEFLATE", "0") == "1"
+# HTTP bodies at least this large (chat histories, the page) are gzipped.
+GZIP_MIN_SIZE = 4096
+# Protocol-level ping/pong keeps idle sockets alive without app frames.
+WS_PING_INTERVAL = float(os.environ.get("WS_PING_INTERVAL", "20"))
+# Seconds between keepalive comments on an idle /status/stream.
+STATUS_KEEPALIVE = 15
+
+# More than one process needs REDIS_URL: the worker and a browser can then
+# sit on different processes and Redis pub/sub relays frames between them.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+REDIS_URL = os.environ.get("REDIS_URL")
+
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
 ALGORITHM = "HS256"
 
+# The SPA shell never changes while the process runs; load and compress it
+# once. Each encoding gets its own ETag so caches never mix them up.
+_INDEX_HTML = Path("index.html").read_bytes()
+_INDEX_HTML_GZ = gzip.compress(_INDEX_HTML, mtime=0)
+_INDEX_ETAG = f'"{hashlib.md5(_INDEX_HTML).hexdigest()}"'
+_INDEX_ETAG_GZ = f'"{hashlib.md5(_INDEX_HTML).hexdigest()}-gzip"'
+_INDEX_HEADERS = {"ETag": _INDEX_ETAG, "Cache-Control": "public, max-age=60", "Vary": "Accept-Encoding"}
+_INDEX_HEADERS_GZ = {**_INDEX_HEADERS, "ETag": _INDEX_ETAG_GZ, "Content-Encoding": "gzip"}
+
 # ---------------- FIREBASE INIT ----------------
-try:
+@functools.lru_cache(maxsize=1)
+def _get_cred_dict():
+    # Parsed once per process; reloads and forked workers reuse the dict.
     encoded_key = os.environ.get("FIREBASE_SERVICE_ACCOUNT_BASE64")
     if not encoded_key:
         raise ValueError("FIREBASE_SERVICE_ACCOUNT_BASE64 not set")
+    return orjson.loads(base64.b64decode(encoded_key))
 
-    decoded_key = base64.b64decode(encoded_key).decode("utf-8")
-    cred = credentials.Certificate(json.loads(decoded_key))
+try:
+    cred = credentials.Certificate(_get_cred_dict())
     firebase_admin.initialize_app(cred)
-    db = firestore.client()
+    # Async client: each RPC yields to the event loop instead of holding a thread.
+    db = firestore_async.client()
     users_collection = db.collection("users")
     chats_collection = db.collection("chats")
     print("✅ Firebase initialized.")
@@ -48,16 +98,43 @@ def create_access_token(data: dict, expires_delta: datetime.timedelta | None = N
         expires_delta or datetime.timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     )
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=ALGORITHM)
+    return jwt.encode(to_encode, _JWT_KEY, algorithm=ALGORITHM)
+
+_ALGS = (ALGORITHM,)
+
+def decode_token(token: str) -> dict:
+    return jwt.decode(token, _JWT_KEY, algorithms=_ALGS)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# token -> (sub, exp) for tokens that already verified, so a burst of API
+# calls with the same token skips the HMAC and JSON decode.
+_TOKEN_CACHE_MAX = 4096
+_token_cache: "dict[str, Tuple[str, float]]" = {}
+
+def _remember_token(token: str, username: str, exp) -> None:
+    if not isinstance(exp, (int, float)):
+        return
+    if len(_token_cache) >= _TOKEN_CACHE_MAX:
+        now = time.time()
+        for key in [k for k, (_, e) in _token_cache.items() if e <= now]:
+            del _token_cache[key]
+        if len(_token_cache) >= _TOKEN_CACHE_MAX:
+            _token_cache.clear()
+    _token_cache[token] = (username, exp)
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    cached = _token_cache.get(token)
+    if cached is not None:
+        if cached[1] > time.time():
+            return cached[0]
+        del _token_cache[token]
     try:
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         username = payload.get("sub")
         if not username:
             raise HTTPException(status_code=401, detail="Invalid token.")
+        _remember_token(token, username, payload.get("exp"))
         return username
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired.")
@@ -70,9 +147,150 @@ def get_password_hash(password):
 def verify_password(plain, hashed): 
     return bcrypt.checkpw(plain.encode(), hashed.encode())
 
+# Logins verified in the last minute, so repeat logins skip the bcrypt KDF.
+# The stored hash is part of the key, so a password change invalidates it.
+# Only touched from the event loop thread, so no lock is needed. Passwords
+# are keyed by an HMAC under a per-process secret, never a plain hash, so a
+# memory dump can't be brute-forced at SHA-256 speed.
+_verified_logins: "TTLCache[Tuple[str, bytes, str], bool]" = TTLCache(maxsize=1024, ttl=60)
+_PROCESS_SECRET = os.urandom(32)
+
+# username -> stored bcrypt hash, so repeat logins skip the Firestore read.
+# Unknown users aren't cached: a signup on another process must be visible.
+# The TTL bounds how long a password changed elsewhere keeps working here.
+_password_hashes: "TTLCache[str, str]" = TTLCache(maxsize=4096, ttl=60)
+
+async def verify_password_cached(user: str, plain: str, hashed: str) -> bool:
+    key = (user, hmac.new(_PROCESS_SECRET, plain.encode(), hashlib.sha256).digest(), hashed)
+    if key in _verified_logins:
+        return True
+    ok = await asyncio.to_thread(verify_password, plain, hashed)
+    if ok:
+        _verified_logins[key] = True
+    return ok
+
 def log(msg): 
     print(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
 
+# Fixed-shape frames are assembled from constant parts; only the user id
+# needs escaping.
+_AUTH_SUCCESS_PREFIX = '{"type": "auth_success", "user_id": '
+_PING_MARKER = '"type":"ping"'
+
+def auth_success_frame(user: str) -> str:
+    return _AUTH_SUCCESS_PREFIX + orjson.dumps(user).decode() + "}"
+
+# Shape of the ids the page generates for guests; anything else (e.g. a
+# registered username passed as guest_id) gets a fresh guest id instead.
+# Signup keeps the guest prefix reserved so the two can't overlap.
+_GUEST_ID_RE = re.compile(r"guest_?[A-Za-z0-9]{1,32}")
+
+# Relay frames are routed without decoding the (often large) payload.
+_USER_ID_RE = re.compile(r'"user_id"\s*:\s*"([^"\\]*)"')
+_JSON_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+def _is_top_level(msg: str, pos: int) -> bool:
+    # Drop string literals so braces inside them don't count, then check
+    # that pos sits directly inside the outermost object.
+    skeleton = _JSON_STRING_RE.sub("", msg[:pos])
+    opened = skeleton.count("{") + skeleton.count("[")
+    return opened - skeleton.count("}") - skeleton.count("]") == 1
+
+def route_user_id(msg: str) -> Optional[str]:
+    # Worker frames carry exactly one top-level user_id; a nested one (e.g.
+    # inside data) or an escaped id falls back to a full parse.
+    if msg.count('"user_id"') == 1:
+        m = _USER_ID_RE.search(msg)
+        if m and _is_top_level(msg, m.start()):
+            return m.group(1)
+    user = orjson.loads(msg).get("user_id")
+    return user if isinstance(user, str) else None
+
+# Frames a lagging browser can lose without breaking an answer.
+_DROPPABLE_TYPES = frozenset({"status", "pong"})
+
+_STREAM_CHUNK_MARKER = '"stream_chunk"'
+
+def coalesce_stream_chunks(first: str, outbox: "asyncio.Queue[str]") -> Tuple[str, Optional[str]]:
+    # Merge stream_chunk frames already waiting behind `first` into one frame.
+    # Returns the frame to send and the first queued frame that didn't fit.
+    head = orjson.loads(first)
+    if head.get("type") != "stream_chunk" or not isinstance(head.get("data"), str):
+        return first, None
+    parts = [head["data"]]
+    size = len(parts[0])
+    leftover = None
+    while size < COALESCE_LIMIT and not outbox.empty():
+        nxt = outbox.get_nowait()
+        d = orjson.loads(nxt) if _STREAM_CHUNK_MARKER in nxt else None
+        if (d is None or d.get("type") != "stream_chunk"
+                or d.get("target") != head.get("target") or not isinstance(d.get("data"), str)):
+            leftover = nxt
+            break
+        parts.append(d["data"])
+        size += len(d["data"])
+    if len(parts) == 1:
+        return first, leftover
+    head["data"] = "".join(parts)
+    return orjson.dumps(head).decode(), leftover
+
+# Binary stream_chunk frames: [type][target][utf-8 data]. Only sent to
+# browsers that asked for them with ?frames=binary.
+_FRAME_STREAM_CHUNK = 1
+_FRAME_TARGETS = {"pdfchat": 0, "aichat": 1}
+
+def binary_stream_chunk(msg: str) -> Optional[bytes]:
+    d = orjson.loads(msg)
+    target = _FRAME_TARGETS.get(d.get("target"))
+    if d.get("type") != "stream_chunk" or target is None or not isinstance(d.get("data"), str):
+        return None
+    return bytes((_FRAME_STREAM_CHUNK, target)) + d["data"].encode()
+
+# Status frames never change, so they're serialized once at import. Pages
+# get their own worker_status type so it never lands in a chat.
+STATUS_WORKER_CONNECTED = orjson.dumps({"type": "worker_status", "worker_connected": True}).decode()
+STATUS_WORKER_DISCONNECTED = orjson.dumps({"type": "worker_status", "worker_connected": False}).decode()
+_STATUS_EVENTS = {
+    ready: "data: " + orjson.dumps({"worker_connected": ready}).decode() + "\n\n"
+    for ready in (True, False)
+}
+
+def _status_event(ready: bool) -> str:
+    return _STATUS_EVENTS[ready]
+
+def batch_frames(first: str, outbox: "asyncio.Queue[str]", stop_at_chunks: bool) -> Tuple[str, Optional[str]]:
+    # Join frames already queued behind `first` into one JSON array frame.
+    # With stop_at_chunks, a stream_chunk ends the batch so it can still go
+    # out as a binary frame. Returns the frame and the first one left out.
+    parts = [first]
+    size = len(first)
+    leftover = None
+    while size < COALESCE_LIMIT and len(parts) < BATCH_MAX_FRAMES and not outbox.empty():
+        nxt = outbox.get_nowait()
+        if stop_at_chunks and _STREAM_CHUNK_MARKER in nxt:
+            leftover = nxt
+            break
+        parts.append(nxt)
+        size += len(nxt)
+    if len(parts) == 1:
+        return first, leftover
+    return "[" + ",".join(parts) + "]", leftover
+
+def user_id_suffix(user: str) -> str:
+    return ',"user_id":' + orjson.dumps(user).decode() + "}"
+
+def tag_with_user(msg: str, user: str, suffix: str) -> str:
+    # Still parsed so malformed frames never reach the worker; a valid
+    # non-empty object just gets user_id appended as its last key, so it
+    # wins over any client-supplied one without re-serializing.
+    data = orjson.loads(msg)
+    if not isinstance(data, dict):
+        raise ValueError("frame is not a JSON object")
+    if data:
+        return msg.strip()[:-1] + suffix
+    data["user_id"] = user
+    return orjson.dumps(data).decode()
+
 # ---------------- MODELS ----------------
 class ChatMessage(BaseModel):
     sender: str
@@ -88,70 +306,415 @@ class ChatData(BaseModel):
     pdfName: Optional[str] = None
 
 # ---------------- CONNECTION MANAGER ----------------
+class WebClient:
+    """A browser socket plus the outbound queue its writer task drains."""
+    __slots__ = ("ws", "outbox", "writer", "binary", "batch")
+
+    def __init__(self, ws: WebSocket, binary: bool = False, batch: bool = False) -> None:
+        self.ws = ws
+        self.binary = binary
+        self.batch = batch
+        self.outbox: "asyncio.Queue[str]" = asyncio.Queue(maxsize=WEB_CLIENT_QUEUE_SIZE)
+        self.writer: "Optional[asyncio.Task[None]]" = None
+
 class ConnectionManager:
-    def __init__(self):
-        self.web_clients = {}  # user_id -> websocket
+    web_clients: "collections.OrderedDict[str, WebClient]"
+    local_worker: Optional[WebSocket]
+    _max_clients: int
+    _worker_ready: bool
+    _worker_outbox: "asyncio.Queue[str]"
+    _worker_writer: "Optional[asyncio.Task[None]]"
+    _status_watchers: "set[asyncio.Queue[bool]]"
+    bridge: "Optional[RedisBridge]"
+    _remote_worker_until: float
+    _remote_worker_expiry: "Optional[asyncio.TimerHandle]"
+    _background: "set[asyncio.Task[None]]"
+
+    def __init__(self) -> None:
+        # user_id -> client, oldest first; bounded so reconnect storms of
+        # fresh guest ids can't grow it forever
+        self.web_clients = collections.OrderedDict()
+        self._max_clients = MAX_WEB_CLIENTS
         self.local_worker = None
-
-    async def connect_web(self, ws: WebSocket, user: str):
-        self.web_clients[user] = ws
+        # Plain flag for the per-message hot path; WebSocket truthiness goes
+        # through Mapping.__len__ on the ASGI scope.
+        self._worker_ready = False
+        self._worker_outbox = asyncio.Queue(maxsize=WORKER_QUEUE_SIZE)
+        self._worker_writer = None
+        # One queue per /status/stream subscriber
+        self._status_watchers = set()
+        # Set when running several processes; see RedisBridge
+        self.bridge = None
+        # monotonic() deadline until which another process's worker counts as up
+        self._remote_worker_until = 0.0
+        self._remote_worker_expiry = None
+        # Fire-and-forget tasks; the event loop only keeps weak references
+        self._background = set()
+
+    @property
+    def worker_connected(self) -> bool:
+        # The worker is connected to this process.
+        return self._worker_ready
+
+    @property
+    def worker_available(self) -> bool:
+        return self._worker_ready or time.monotonic() < self._remote_worker_until
+
+    async def connect_web(self, ws: WebSocket, user: str, binary: bool = False, batch: bool = False) -> None:
+        replaced = self.web_clients.pop(user, None)
+        if replaced is not None:
+            self._stop_writer(replaced)
+        elif len(self.web_clients) >= self._max_clients:
+            old_user, old_client = self.web_clients.popitem(last=False)
+            self._stop_writer(old_client)
+            self._spawn(old_client.ws.close(code=1013))
+            log(f"♻️ Evicted web client {old_user} (limit {self._max_clients})")
+        client = WebClient(ws, binary, batch)
+        client.writer = asyncio.create_task(self._drain_web(user, client))
+        self.web_clients[user] = client
         log(f"🌐 Web client {user} connected")
 
-    async def connect_worker(self, ws: WebSocket):
+    async def connect_worker(self, ws: WebSocket) -> None:
+        # A second worker replaces the first; its writer must not keep running.
+        if self._worker_writer is not None:
+            self._worker_writer.cancel()
         self.local_worker = ws
+        self._worker_outbox = asyncio.Queue(maxsize=WORKER_QUEUE_SIZE)
+        self._worker_writer = asyncio.create_task(self._drain_worker(ws, self._worker_outbox))
+        self._worker_ready = True
+        self._worker_changed()
         log("🤖 Worker connected and authenticated")
 
-    async def disconnect_worker(self):
+    async def disconnect_worker(self, ws: Optional[WebSocket] = None) -> None:
+        if ws is not None and self.local_worker is not ws:
+            return
+        self._worker_ready = False
         self.local_worker = None
+        if self._worker_writer is not None:
+            self._worker_writer.cancel()
+            self._worker_writer = None
+        self._discard_worker_outbox()
+        self._worker_changed()
         log("❌ Worker disconnected")
 
-    def disconnect_web(self, user: str):
-        if user in self.web_clients:
+    def disconnect_web(self, user: str, ws: Optional[WebSocket] = None) -> None:
+        # Only drop the entry if it is still ours; a reconnect may have
+        # replaced it, or eviction already removed it.
+        client = self.web_clients.get(user)
+        if client is not None and (ws is None or client.ws is ws):
             del self.web_clients[user]
+            self._stop_writer(client)
         log(f"🧑‍💻 Web client {user} disconnected")
 
-    async def send_to_worker(self, msg: str):
-        if self.local_worker:
-            try:
-                await self.local_worker.send_text(msg)
-            except Exception as e:
-                log(f"Error sending to worker: {e}")
+    async def send_to_worker(self, msg: str) -> None:
+        if self._worker_ready:
+            # Waiting here only holds up the client that sent msg.
+            await self._worker_outbox.put(msg)
+        elif self.bridge is not None:
+            await self.bridge.publish(_BRIDGE_TO_WORKER, msg)
         else:
             log("⚠️  No worker connected")
 
-    async def send_to_client(self, msg: str):
+    async def relay_to_worker(self, msg: str) -> None:
+        # Frames from other processes are never published back out, so two
+        # processes without a worker can't bounce a frame between them.
+        if self._worker_ready:
+            await self._worker_outbox.put(msg)
+
+    async def send_to_client(self, msg: str) -> None:
+        if not self.deliver(msg) and self.bridge is not None:
+            await self.bridge.publish(_BRIDGE_TO_WEB, msg)
+
+    def deliver(self, msg: str) -> bool:
+        # Queue msg for a browser connected to this process. Returns False
+        # only if the target isn't here, so the caller can relay it on.
         try:
-            data = json.loads(msg)
-            user = data.get("user_id")
-            if user and user in self.web_clients:
-                await self.web_clients[user].send_text(msg)
+            user = route_user_id(msg)
+            client = self.web_clients.get(user) if user is not None else None
+            if client is None:
+                return False
+            try:
+                client.outbox.put_nowait(msg)
+            except asyncio.QueueFull:
+                # A stalled browser must not block the shared worker relay.
+                # Status noise can go; anything else would corrupt the
+                # answer, so cut the client loose and let it reconnect.
+                if orjson.loads(msg).get("type") in _DROPPABLE_TYPES:
+                    return True
+                log(f"⚠️  Web client {user} is not keeping up; disconnecting")
+                self.disconnect_web(user, client.ws)
+                self._spawn(client.ws.close(code=1013))
         except Exception as e:
             log(f"Error sending to client: {e}")
+        return True
+
+    def broadcast_status(self, payload: str) -> None:
+        # Enqueue the same frame everywhere; each client's writer does the
+        # actual send, so one slow socket can't delay the rest.
+        for client in self.web_clients.values():
+            try:
+                client.outbox.put_nowait(payload)
+            except asyncio.QueueFull:
+                pass
+
+    async def _drain_web(self, user: str, client: WebClient) -> None:
+        outbox = client.outbox
+        pending: Optional[str] = None
+        try:
+            while True:
+                msg = pending if pending is not None else await outbox.get()
+                pending = None
+                if _STREAM_CHUNK_MARKER in msg:
+                    # Only a backlog is merged, so an idle stream is never delayed.
+                    if not outbox.empty():
+                        msg, pending = coalesce_stream_chunks(msg, outbox)
+                    frame = binary_stream_chunk(msg) if client.binary else None
+                    if frame is not None:
+                        await client.ws.send_bytes(frame)
+                        continue
+                if client.batch and pending is None and not outbox.empty():
+                    msg, pending = batch_frames(msg, outbox, client.binary)
+                await client.ws.send_text(msg)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log(f"Error sending to client {user}: {e}")
+            self.disconnect_web(user, client.ws)
+
+    async def _drain_worker(self, ws: WebSocket, outbox: "asyncio.Queue[str]") -> None:
+        try:
+            while True:
+                msg = await outbox.get()
+                await ws.send_text(msg)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._worker_ready = False
+            log(f"Error sending to worker: {e}")
+            self._discard_worker_outbox()
+            self._worker_changed()
+
+    def watch_status(self) -> "asyncio.Queue[bool]":
+        q: "asyncio.Queue[bool]" = asyncio.Queue(maxsize=1)
+        self._status_watchers.add(q)
+        return q
+
+    def unwatch_status(self, q: "asyncio.Queue[bool]") -> None:
+        self._status_watchers.discard(q)
+
+    def set_remote_worker(self, ready: bool) -> None:
+        was_available = self.worker_available
+        if self._remote_worker_expiry is not None:
+            self._remote_worker_expiry.cancel()
+            self._remote_worker_expiry = None
+        if ready:
+            self._remote_worker_until = time.monotonic() + 3 * STATUS_KEEPALIVE
+            # Fires only if the heartbeats stop without a goodbye.
+            self._remote_worker_expiry = asyncio.get_running_loop().call_later(
+                3 * STATUS_KEEPALIVE, self._remote_worker_lapsed)
+        else:
+            self._remote_worker_until = 0.0
+        if self.worker_available != was_available:
+            self._publish_status()
+
+    def _remote_worker_lapsed(self) -> None:
+        self._remote_worker_expiry = None
+        self._remote_worker_until = 0.0
+        log("⚠️  Remote worker heartbeat lapsed")
+        if not self._worker_ready:
+            self._publish_status()
+
+    def _worker_changed(self) -> None:
+        self._publish_status()
+        if self.bridge is not None:
+            self._spawn(self.bridge.announce_worker(self._worker_ready))
+
+    def _spawn(self, coro: "Coroutine[Any, Any, None]") -> None:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task: "asyncio.Task[None]") -> None:
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log(f"Background task failed: {task.exception()}")
+
+    def _publish_status(self) -> None:
+        # Runs for local and remote worker changes alike, so pages on every
+        # process hear about it. Subscribers only care about the latest
+        # state, so replace any value they haven't read yet.
+        available = self.worker_available
+        for q in self._status_watchers:
+            if q.full():
+                q.get_nowait()
+            q.put_nowait(available)
+        self.broadcast_status(STATUS_WORKER_CONNECTED if available else STATUS_WORKER_DISCONNECTED)
+
+    def _discard_worker_outbox(self) -> None:
+        # Emptying the queue wakes any client blocked on a full put().
+        while True:
+            try:
+                self._worker_outbox.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+
+    @staticmethod
+    def _stop_writer(client: WebClient) -> None:
+        if client.writer is not None:
+            client.writer.cancel()
+            client.writer = None
+
+_BRIDGE_TO_WORKER = "pdchatter:to_worker"
+_BRIDGE_TO_WEB = "pdchatter:to_web"
+_BRIDGE_WORKER_STATUS = "pdchatter:worker_status"
+# Tags this process's publishes so it can ignore its own echoes.
+_PROCESS_ID = os.urandom(4).hex()
+
+class RedisBridge:
+    """Relays frames between processes when WEB_CONCURRENCY > 1.
+
+    Browser frames go to whichever process holds the worker, worker frames to
+    whichever process holds the browser, and the worker's process heartbeats
+    its status so every process's /status agrees.
+    """
+
+    def __init__(self, url: str, manager: ConnectionManager) -> None:
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self._pubsub = self._redis.pubsub()
+        self._manager = manager
+        self._tasks: "List[asyncio.Task[None]]" = []
+
+    async def start(self) -> None:
+        await self._pubsub.subscribe(_BRIDGE_TO_WORKER, _BRIDGE_TO_WEB, _BRIDGE_WORKER_STATUS)
+        self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._heartbeat())]
+        log(f"🔀 Redis bridge started (process {_PROCESS_ID})")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await self._pubsub.aclose()
+        await self._redis.aclose()
+
+    async def publish(self, channel: str, msg: str) -> None:
+        await self._redis.publish(channel, f"{_PROCESS_ID} {msg}")
+
+    async def announce_worker(self, ready: bool) -> None:
+        try:
+            await self.publish(_BRIDGE_WORKER_STATUS, "1" if ready else "0")
+        except Exception as e:
+            log(f"Redis status publish failed: {e}")
+
+    async def _heartbeat(self) -> None:
+        # Lets processes that started after the worker connected learn of it,
+        # and lets the state lapse if this process dies without a goodbye.
+        while True:
+            await asyncio.sleep(STATUS_KEEPALIVE)
+            if self._manager.worker_connected:
+                await self.announce_worker(True)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async for item in self._pubsub.listen():
+                    if item["type"] != "message":
+                        continue
+                    origin, _, msg = item["data"].partition(" ")
+                    if origin == _PROCESS_ID:
+                        continue
+                    channel = item["channel"]
+                    if channel == _BRIDGE_TO_WEB:
+                        self._manager.deliver(msg)
+                    elif channel == _BRIDGE_TO_WORKER:
+                        await self._manager.relay_to_worker(msg)
+                    elif channel == _BRIDGE_WORKER_STATUS:
+                        self._manager.set_remote_worker(msg == "1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log(f"Redis bridge error: {e}; retrying")
+                await asyncio.sleep(1)
 
 manager = ConnectionManager()
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if REDIS_URL:
+        manager.bridge = RedisBridge(REDIS_URL, manager)
+        await manager.bridge.start()
+    yield
+    if manager.bridge is not None:
+        await manager.bridge.stop()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# gzip buffers output, which would hold back server-sent events, and the
+# index is compressed ahead of time.
+_GZIP_SKIP_PATHS = frozenset({"/", "/status/stream"})
+
+class _GZipExceptEventStream:
+    def __init__(self, app) -> None:
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=GZIP_MIN_SIZE)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http" and scope["path"] not in _GZIP_SKIP_PATHS:
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+app.add_middleware(_GZipExceptEventStream)
 
 # ---------------- ROUTES ----------------
 @app.get("/")
-async def index():
-    return FileResponse("index.html")
+async def index(request: Request):
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        body, etag, headers = _INDEX_HTML_GZ, _INDEX_ETAG_GZ, _INDEX_HEADERS_GZ
+    else:
+        body, etag, headers = _INDEX_HTML, _INDEX_ETAG, _INDEX_HEADERS
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="text/html", headers=headers)
 
 @app.get("/status")
 async def status():
-    return {
-        "worker_connected": manager.local_worker is not None,
+    # Returning the response object skips FastAPI's jsonable_encoder pass;
+    # these payloads are already plain JSON types.
+    return ORJSONResponse({
+        "worker_connected": manager.worker_available,
         "clients": list(manager.web_clients.keys()),
-    }
+    })
+
+@app.get("/status/stream")
+async def status_stream(request: Request):
+    async def events():
+        q = manager.watch_status()
+        try:
+            yield _status_event(manager.worker_available)
+            while not await request.is_disconnected():
+                try:
+                    ready = await asyncio.wait_for(q.get(), STATUS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Comment lines keep proxies from closing an idle stream.
+                    yield ": keepalive\n\n"
+                    continue
+                yield _status_event(ready)
+        finally:
+            manager.unwatch_status(q)
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.post("/signup")
 async def signup(data: dict = Body(...)):
     u, p = data.get("username"), data.get("password")
     if not u or not p: 
         raise HTTPException(400, "Missing credentials")
+    if u.startswith("guest"):
+        raise HTTPException(400, "Usernames starting with 'guest' are reserved")
     ref = users_collection.document(u)
-    if ref.get().exists: 
+    if (await ref.get()).exists: 
         raise HTTPException(400, "User exists")
-    ref.set({"username": u, "password": get_password_hash(p)})
+    hashed = await asyncio.to_thread(get_password_hash, p)
+    await ref.set({"username": u, "password": hashed})
+    _password_hashes[u] = hashed
     log(f"New user: {u}")
     return {"message": "User created"}
 
@@ -160,12 +723,21 @@ async def signup(data: dict = Body(...)):
 @app.post("/token")
 async def login(data: dict = Body(...)):
     u, p = data.get("username"), data.get("password")
-    ref = users_collection.document(u)
-    doc = ref.get()
-    if not doc.exists: 
-        raise HTTPException(401, "Invalid login")
-    if not verify_password(p, doc.to_dict().get("password")):
-        raise HTTPException(401, "Invalid login")
+    cached = _password_hashes.get(u)
+    if cached is None or not await verify_password_cached(u, p, cached):
+        # The cached hash may predate a password change, so check the real
+        # one, but only spend another bcrypt run if it actually differs.
+        doc = await users_collection.document(u).get()
+        if not doc.exists: 
+            _password_hashes.pop(u, None)
+            raise HTTPException(401, "Invalid login")
+        stored = doc.to_dict().get("password")
+        if stored != cached:
+            _password_hashes.pop(u, None)
+        if stored == cached or not await verify_password_cached(u, p, stored):
+            raise HTTPException(401, "Invalid login")
+        # Only hashes that just verified are cached.
+        _password_hashes[u] = stored
     token = create_access_token({"sub": u})
     log(f"{u} logged in")
     return {"access_token": token, "token": token, "token_type": "bearer"}
@@ -173,7 +745,8 @@ async def login(data: dict = Body(...)):
 @app.get("/chats")
 async def get_chats(current_user: str = Depends(get_current_user)):
     chats = []
-    for doc in chats_collection.where("userId", "==", current_user).stream():
+    query = chats_collection.where("userId", "==", current_user)
+    async for doc in query.stream():
         d = doc.to_dict()
         chats.append({
             "id": doc.id,  # Use Firestore document ID
@@ -182,11 +755,11 @@ async def get_chats(current_user: str = Depends(get_current_user)):
             "type": d.get("type"),
             "pdfName": d.get("pdfName")
         })
-    return chats
+    return ORJSONResponse(chats)
 
 @app.get("/chats/{cid}")
 async def get_chat(cid: str, current_user: str = Depends(get_current_user)):
-    doc = chats_collection.document(cid).get()
+    doc = await chats_collection.document(cid).get()
     if not doc.exists:
         raise HTTPException(404, "Chat not found")
     
@@ -210,12 +783,14 @@ async def get_chat(cid: str, current_user: str = Depends(get_current_user)):
     d["id"] = doc.id
     
     log(f"📤 Returning chat {cid} with {len(d['history'])} messages")
-    return d
+    return ORJSONResponse(d)
 
 @app.post("/chats")
 async def save_chat(chat: ChatData, current_user: str = Depends(get_current_user)):
-    d = chat.dict()
+    d = chat.model_dump()
     d["userId"] = current_user
+    # The Firestore document ID is the chat ID; don't store it twice
+    d.pop("id", None)
     
     # Ensure history is properly formatted as a list
     if isinstance(d.get("history"), list):
@@ -231,10 +806,9 @@ async def save_chat(chat: ChatData, current_user: str = Depends(get_current_user
     else:
         d["history"] = []
     
-    # Create new document with auto-generated ID
+    # Create new document with auto-generated ID (create() fails on collision)
     doc_ref = chats_collection.document()
-    d["id"] = doc_ref.id
-    doc_ref.set(d)
+    await doc_ref.create(d)
     
     log(f"💾 Chat saved for {current_user} with ID {doc_ref.id}, {len(d['history'])} messages")
     return {"ok": True, "id": doc_ref.id}
@@ -242,7 +816,7 @@ async def save_chat(chat: ChatData, current_user: str = Depends(get_current_user
 @app.put("/chats/{cid}")
 async def update_chat(cid: str, chat: ChatData, current_user: str = Depends(get_current_user)):
     doc_ref = chats_collection.document(cid)
-    doc = doc_ref.get()
+    doc = await doc_ref.get()
     
     if not doc.exists:
         raise HTTPException(404, "Chat not found")
@@ -251,10 +825,10 @@ async def update_chat(cid: str, chat: ChatData, current_user: str = Depends(get_
     if doc.to_dict().get("userId") != current_user:
         raise HTTPException(403, "Forbidden")
     
-    d = chat.dict()
+    d = chat.model_dump()
     d["userId"] = current_user
-    d["id"] = cid
-    doc_ref.set(d)
+    d.pop("id", None)
+    await doc_ref.set(d)
     
     log(f"💾 Chat updated for {current_user}")
     return {"ok": True, "id": cid}
@@ -262,7 +836,7 @@ async def update_chat(cid: str, chat: ChatData, current_user: str = Depends(get_
 @app.delete("/chats/{cid}")
 async def delete_chat(cid: str, current_user: str = Depends(get_current_user)):
     doc_ref = chats_collection.document(cid)
-    doc = doc_ref.get()
+    doc = await doc_ref.get()
     
     if not doc.exists:
         raise HTTPException(404, "Chat not found")
@@ -271,7 +845,7 @@ async def delete_chat(cid: str, current_user: str = Depends(get_current_user)):
     if doc.to_dict().get("userId") != current_user:
         raise HTTPException(403, "Forbidden")
     
-    doc_ref.delete()
+    await doc_ref.delete()
     log(f"🗑️ Chat {cid} deleted for {current_user}")
     return {"ok": True}
 
@@ -280,19 +854,31 @@ async def delete_chat(cid: str, current_user: str = Depends(get_current_user)):
 async def ws_worker(ws: WebSocket):
     await ws.accept()
     try:
-        auth = json.loads(await ws.receive_text())
+        auth = orjson.loads(await ws.receive_text())
         if auth.get("type") != "auth" or auth.get("secret") != WORKER_SECRET_KEY:
             await ws.close(code=1008, reason="Auth failed")
             return
         await manager.connect_worker(ws)
         
-        async for msg in ws.iter_text():
+        while True:
+            frame = await ws.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            msg = frame.get("text")
+            if msg is None:
+                # A worker may send its JSON as UTF-8 binary frames; routing
+                # and the browsers work on text, so decode once here.
+                data = frame.get("bytes")
+                if not data:
+                    continue
+                msg = data.decode()
             await manager.send_to_client(msg)
+        await manager.disconnect_worker(ws)
     except WebSocketDisconnect:
-        await manager.disconnect_worker()
+        await manager.disconnect_worker(ws)
     except Exception as e:
         log(f"Worker error: {e}")
-        await manager.disconnect_worker()
+        await manager.disconnect_worker(ws)
 
 @app.websocket("/ws")
 @app.websocket("/ws/web")
@@ -306,21 +892,21 @@ async def ws_web(ws: WebSocket):
         
         if token:
             try:
-                payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[ALGORITHM])
+                payload = decode_token(token)
                 user = payload.get("sub")
             except:
                 pass
         
         if not user and guest_id:
-            user = guest_id
+            user = guest_id if _GUEST_ID_RE.fullmatch(guest_id) else f"guest_{os.urandom(3).hex()}"
         
         if not user:
             # Expect auth message
             msg = await ws.receive_text()
-            d = json.loads(msg)
+            d = orjson.loads(msg)
             if "token" in d:
                 try:
-                    payload = jwt.decode(d["token"], JWT_SECRET_KEY, algorithms=[ALGORITHM])
+                    payload = decode_token(d["token"])
                     user = payload.get("sub")
                 except:
                     pass
@@ -328,22 +914,46 @@ async def ws_web(ws: WebSocket):
         if not user:
             user = f"guest_{os.urandom(3).hex()}"
 
-        await manager.connect_web(ws, user)
-        await ws.send_text(json.dumps({"type": "auth_success", "user_id": user}))
-
-        async for msg in ws.iter_text():
+        params = ws.query_params
+        await manager.connect_web(ws, user, params.get("frames") == "binary", params.get("batch") == "1")
+        await ws.send_text(auth_success_frame(user))
+        suffix = user_id_suffix(user)
+
+        while True:
+            frame = await ws.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            msg = frame.get("text")
+            # Binary frames from the browser are 1-byte heartbeats; older
+            # pages still send JSON pings. Neither needs to reach the worker.
+            if msg is None or _PING_MARKER in msg:
+                continue
             try:
-                data = json.loads(msg)
-                data["user_id"] = user
-                await manager.send_to_worker(json.dumps(data))
+                await manager.send_to_worker(tag_with_user(msg, user, suffix))
             except Exception as e:
                 log(f"Error processing message from {user}: {e}")
+        manager.disconnect_web(user, ws)
                 
     except WebSocketDisconnect:
-        manager.disconnect_web(user or "unknown")
+        manager.disconnect_web(user or "unknown", ws)
     except Exception as e:
         log(f"Web client error: {e}")
-        manager.disconnect_web(user or "unknown")
+        manager.disconnect_web(user or "unknown", ws)
 
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=int(os.getenv("PORT", "10000")))
+    workers = WEB_CONCURRENCY
+    if workers > 1 and not REDIS_URL:
+        print("⚠️  WEB_CONCURRENCY > 1 needs REDIS_URL; running a single worker.")
+        workers = 1
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "10000")),
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE,
+        ws_ping_interval=WS_PING_INTERVAL,
+        ws_ping_timeout=WS_PING_INTERVAL,
+        workers=workers,
+    )